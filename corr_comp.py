@@ -14,10 +14,32 @@ import random
 import shutil
 import platform
 import sys
+import tempfile
+import contextlib
+
+# Import optional packages/modules
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Import modules/packages argument parser
 import argparse
 
+# Define constants
+# Default permissions for newly created output files (read once, as the umask can only be read by setting it)
+_umask = os.umask(0)
+os.umask(_umask)
+DEFAULT_FILE_MODE = 0o666 & ~_umask
+
+# Fixed length (bytes) of the HDF5 string (file path) columns (i.e. PATH_MAX on Linux)
+HDF5_STR_LEN = 4096
+
 # Define class(es)
 class Command(object):
     '''
@@ -423,9 +445,77 @@ def pearson_corr(file1,file2,log_file=""):
     # Compute Pearson correlation (assumes A & B are N x 1 matrices/arrays)
     return remove_diagonal(np.tril(np.corrcoef(A,B),k=0)).flatten(order='C')[1]
 
+def atomic_write(out_file,write_func):
+    '''
+    Writes a file atomically. The contents are written to a temporary file in the
+    same directory as the output file, which then replaces the output file. Readers
+    of the output file therefore never see a partially written file.
+    
+    Arguments:
+        out_file(file): Output file name
+        write_func(function): Function that accepts an open (read/write) binary file object and writes to it
+    Returns:
+        out_file(file): Output file name
+    '''
+    
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+    fd,tmp_file = tempfile.mkstemp(dir=out_dir,suffix=".tmp")
+    
+    # Keep the permissions of the replaced file, otherwise apply default file permissions
+    # (mkstemp creates files readable by the owner only)
+    if os.path.exists(out_file):
+        shutil.copymode(out_file,tmp_file)
+    else:
+        os.chmod(tmp_file,DEFAULT_FILE_MODE)
+    
+    try:
+        with os.fdopen(fd,"w+b") as file:
+            write_func(file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_file,out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return out_file
+
+@contextlib.contextmanager
+def lock_file(out_file):
+    '''
+    Holds an exclusive lock for some output file, so that concurrent processes
+    writing/appending to the same output file do so one at a time. The lock is
+    held on a sidecar lock file (i.e. 'out_file.lock'), which is left in place.
+    
+    Usage:
+        with lock_file("cohort.pear_corr.npz"):
+            # Read, modify, and replace "cohort.pear_corr.npz"
+    
+    NOTE: File locking requires support from the filesystem (e.g. Lustre must be mounted with '-o flock').
+    
+    Arguments:
+        out_file(file): Output file name
+    '''
+    
+    if fcntl is None:
+        raise OSError("File locking (fcntl) is not supported on this platform.")
+    
+    with open(out_file + ".lock","a") as lock:
+        try:
+            fcntl.flock(lock.fileno(),fcntl.LOCK_EX)
+        except OSError as err:
+            raise OSError(err.errno,f"Unable to lock {out_file + '.lock'}. The filesystem may not support file locking "
+                                    f"(e.g. Lustre mounted without '-o flock', or some NFS setups): {err.strerror}") from err
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(),fcntl.LOCK_UN)
+
 def write_to_file(out_file,text=""):
     '''
-    Writes text to file.
+    Writes text to file (atomically).
+    
+    NOTE: Floating point numbers are written with full (round-trip) precision.
     
     Arguments:
         out_file(file): Output file name
@@ -435,16 +525,109 @@ def write_to_file(out_file,text=""):
     '''
     
     # Convert text to string if not string
-    if not isinstance(text,str):
+    if isinstance(text,(float,np.floating)):
+        text = repr(float(text))
+    elif not isinstance(text,str):
         text = str(text)
         
     # Write text to file
-    with open(out_file,"w") as file:
-        file.write(text + "\n")
-        file.close()
-    return out_file
+    return atomic_write(out_file,lambda file: file.write((text + "\n").encode('utf-8')))
+
+def write_results(out_file,records,out_format="npz",append=False):
+    '''
+    Writes a batch of Pearson correlation results to a single binary file. Each result is
+    stored as one row of a table with the columns: 'cii', 'seed_mask', 'stat_mask', and 'pear_corr'.
+    
+    Usage:
+        # Write two results to a new file
+        write_results("cohort.pear_corr.npz",[("sub-01.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",0.42),
+                                              ("sub-02.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",-0.13)])
+        
+        # Append another result to the same file
+        write_results("cohort.pear_corr.npz",[("sub-03.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",0.27)],append=True)
+    
+    NOTE: 
+        - NPZ files are re-written atomically on each call, so appending re-writes the whole file.
+          The 'npz' format is therefore only suited to small cohorts (use the 'hdf5' format otherwise).
+        - HDF5 files are created atomically and appended to in place. The 'pear_corr' column is written last,
+          so should an append be interrupted, the next append overwrites the incomplete row.
+        - HDF5 string columns are stored as (compressed) fixed length strings of up to HDF5_STR_LEN bytes.
+        - Concurrent writes/appends to the same file are serialized through the lock file 'out_file.lock'.
+    
+    Arguments:
+        out_file(file): Output file name
+        records(list): List of (cii, seed_mask, stat_mask, corr_coeff) tuples
+        out_format(str): Output file format. Valid formats include: 'npz' and 'hdf5'
+        append(bool): Append results to the output file should it exist
+    Returns:
+        out_file(file): Output file name
+    '''
+    
+    if len(records) == 0:
+        raise ValueError("No records to write.")
+    
+    if out_format not in ("npz","hdf5"):
+        raise ValueError(f"Unsupported output format: {out_format}")
+    
+    if out_format == "hdf5" and h5py is None:
+        raise ImportError("The 'h5py' package is required to write HDF5 files.")
+    
+    # Arrange records into columns
+    [cii,seed_mask,stat_mask,corr_coeff] = zip(*records)
+    columns = {"cii": np.array(cii,dtype=str),
+               "seed_mask": np.array(seed_mask,dtype=str),
+               "stat_mask": np.array(stat_mask,dtype=str),
+               "pear_corr": np.array(corr_coeff,dtype=np.float64)}
+    
+    with lock_file(out_file):
+        append = append and os.path.exists(out_file)
+        
+        if out_format == "npz":
+            if append:
+                with np.load(out_file) as prev:
+                    missing = [key for key in columns if key not in prev.files]
+                    if missing:
+                        raise ValueError(f"{out_file} is missing the column(s): {', '.join(missing)}")
+                    columns = {key: np.concatenate((prev[key],val)) for key,val in columns.items()}
+            return atomic_write(out_file,lambda file: np.savez(file,**columns))
+        
+        # Encode string columns (HDF5 fixed length strings)
+        str_dtype = h5py.string_dtype("utf-8",length=HDF5_STR_LEN)
+        for key in ("cii","seed_mask","stat_mask"):
+            val = np.char.encode(columns[key],"utf-8")
+            if val.dtype.itemsize > HDF5_STR_LEN:
+                raise ValueError(f"Column '{key}' contains values longer than {HDF5_STR_LEN} bytes.")
+            columns[key] = val.astype(str_dtype)
+        
+        if append:
+            with h5py.File(out_file,"a") as f:
+                missing = [key for key in columns if key not in f]
+                if missing:
+                    raise ValueError(f"{out_file} is missing the dataset(s): {', '.join(missing)}")
+                
+                # Number of complete rows (the 'pear_corr' column is written last)
+                n = f["pear_corr"].shape[0]
+                short = [key for key in columns if f[key].shape[0] < n]
+                if short:
+                    raise ValueError(f"{out_file} has dataset(s) with missing rows: {', '.join(short)}")
+                
+                for key,val in columns.items():
+                    f[key].resize((n + len(val),))
+                    f[key][n:] = val
+                    f.flush()
+            return out_file
+        
+        def write_hdf5(file):
+            # Persistent free-space tracking allows space freed by re-written (compressed) chunks to be re-used
+            with h5py.File(file,"w",fs_strategy="fsm",fs_persist=True,fs_threshold=1) as f:
+                for key,val in columns.items():
+                    if key == "pear_corr":
+                        f.create_dataset(key,data=val,maxshape=(None,),chunks=(4096,))
+                    else:
+                        f.create_dataset(key,data=val,maxshape=(None,),chunks=(16,),compression="gzip")
+        return atomic_write(out_file,write_hdf5)
 
-def corr_comp(cii,seed_mask,stat_mask,out_prefix,thresh=0,log_file="file.log",debug=False,dryrun=False,env=None,stdout="",shell=False,verbose=False,keep_tmp_dir=False):
+def corr_comp(cii,seed_mask,stat_mask,out_prefix,thresh=0,log_file="file.log",debug=False,dryrun=False,env=None,stdout="",shell=False,verbose=False,keep_tmp_dir=False,out_format="txt",append=False):
     '''
     Computes mean timeseries for some input CIFTI-2 file with some CIFTI-2 mask file.
     
@@ -462,8 +645,12 @@ def corr_comp(cii,seed_mask,stat_mask,out_prefix,thresh=0,log_file="file.log",de
             - NOTE: This file can only be written to if `shell` is set to False.
         shell(bool): Run the command using a shell.
         verbose(bool): Turn on verbose/diagnostic messages for UNIX command
+        keep_tmp_dir(bool): Keep temporary working directory
+        out_format(str): Output file format. Valid formats include: 'txt', 'npz', and 'hdf5'
+        append(bool): Append result to the output file should it exist (not valid for 'txt')
     Returns:
-        out(file): Output file name for NIFTI-1 file
+        corr_coeff(float): Pearson correlation coefficient
+        out_file(file): Output file name
     '''
     
     # Ascertain absolute file paths
@@ -532,10 +719,17 @@ def corr_comp(cii,seed_mask,stat_mask,out_prefix,thresh=0,log_file="file.log",de
         os.chdir(cwd)
         
     # Write result to file
-    text_file = out_prefix + ".pear_corr.txt" 
-    text_file = write_to_file(out_file=text_file,text=corr_coeff)
+    if out_format == "txt":
+        out_file = out_prefix + ".pear_corr.txt"
+        out_file = write_to_file(out_file=out_file,text=corr_coeff)
+    else:
+        out_file = out_prefix + ".pear_corr" + {"npz": ".npz", "hdf5": ".h5"}[out_format]
+        out_file = write_results(out_file=out_file,
+                                 records=[(cii,seed_mask,stat_mask,corr_coeff)],
+                                 out_format=out_format,
+                                 append=append)
     
-    return corr_coeff,text_file
+    return corr_coeff,out_file
 
 # Write main function
 def main():
@@ -569,7 +763,7 @@ def main():
     # Argument parser
     parser = argparse.ArgumentParser(
         description="Computes the Pearson correlation coefficient between two masks (one being a seed mask and the other being a statistics mask). \
-                    The Pearson correlation coefficient is written to an output file ending with '.pear_corr.txt'.")
+                    The Pearson correlation coefficient is written to an output file ending with '.pear_corr.txt' (or '.pear_corr.npz'/'.pear_corr.h5').")
 
     # Parse Arguments
     # Required Arguments
@@ -639,6 +833,20 @@ def main():
                             required=False,
                             default=False,
                             help="Keep temporary working directory. [default: 'disabled']")
+    optoptions.add_argument('-f', '-format', '--output-format',
+                            type=str,
+                            dest="out_format",
+                            metavar="FORMAT",
+                            choices=["txt","npz","hdf5"],
+                            default="txt",
+                            required=False,
+                            help="Output file format. Valid formats include: 'txt', 'npz', and 'hdf5'. [default: 'txt']")
+    optoptions.add_argument('--append',
+                            dest="append",
+                            action="store_true",
+                            required=False,
+                            default=False,
+                            help="Append result to the output file should it exist (e.g. to collect the results of a cohort in one file). Concurrent appends are serialized through a lock file (the output file name ending with '.lock'), which requires file locking support from the filesystem (e.g. Lustre mounted with '-o flock'). The 'npz' format re-writes the whole file on each append, use the 'hdf5' format for large cohorts. Not valid for the 'txt' output format. [default: 'disabled']")
 
     args = parser.parse_args()
 
@@ -650,19 +858,30 @@ def main():
         if err.code == 2:
             parser.print_help()
 
-    [corr_coeff, text_file] = corr_comp(cii=args.cii_file,
-                                        seed_mask=args.seed_mask,
-                                        stat_mask=args.stat_mask,
-                                        out_prefix=args.out_prefix,
-                                        thresh=args.thresh,
-                                        log_file=args.log_file,
-                                        debug=args.debug,
-                                        dryrun=args.dryrun,
-                                        env=None,
-                                        stdout="",
-                                        shell=False,
-                                        verbose=args.verbose,
-                                        keep_tmp_dir=args.keep_tmp)
+    if args.append and args.out_format == "txt":
+        parser.error("--append requires the 'npz' or 'hdf5' output format.")
+
+    if args.out_format == "hdf5" and h5py is None:
+        print("")
+        print("\tThe required python package (h5py) for the 'hdf5' output format is not installed. Exiting.")
+        print("")
+        sys.exit(1)
+
+    [corr_coeff, out_file] = corr_comp(cii=args.cii_file,
+                                       seed_mask=args.seed_mask,
+                                       stat_mask=args.stat_mask,
+                                       out_prefix=args.out_prefix,
+                                       thresh=args.thresh,
+                                       log_file=args.log_file,
+                                       debug=args.debug,
+                                       dryrun=args.dryrun,
+                                       env=None,
+                                       stdout="",
+                                       shell=False,
+                                       verbose=args.verbose,
+                                       keep_tmp_dir=args.keep_tmp,
+                                       out_format=args.out_format,
+                                       append=args.append)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,201 @@
+'''
+Tests for the result writers in corr_comp.py.
+'''
+
+# Import packages/modules
+import errno
+import glob
+import multiprocessing
+import os
+import stat
+
+import numpy as np
+import pytest
+
+import corr_comp
+from corr_comp import DEFAULT_FILE_MODE, HDF5_STR_LEN, atomic_write, write_results, write_to_file
+
+# Define test data
+RECORDS = [("sub-01.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",0.1 + 0.2),
+           ("sub-02.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",-0.4747918532163404)]
+APPEND_RECORDS = [("sub-03.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",1/3)]
+
+# Define functions
+def read_results(out_file,out_format):
+    '''
+    Reads the result table written by write_results into a dictionary of numpy arrays.
+    '''
+    if out_format == "npz":
+        with np.load(out_file) as f:
+            return {key: f[key] for key in f.files}
+
+    h5py = pytest.importorskip("h5py")
+    with h5py.File(out_file,"r") as f:
+        return {key: f[key].asstr()[:] if key != "pear_corr" else f[key][:] for key in f.keys()}
+
+def append_worker(args):
+    '''
+    Appends a single record to some output file (used for concurrency tests).
+    '''
+    out_file,out_format,i = args
+    write_results(out_file,[(f"sub-{i:02d}.dtseries.nii","seed.dscalar.nii","stat.dscalar.nii",float(i))],
+                  out_format=out_format,
+                  append=True)
+
+@pytest.fixture(params=["npz","hdf5"])
+def out_format(request):
+    if request.param == "hdf5":
+        pytest.importorskip("h5py")
+    return request.param
+
+def test_write_results_append(tmp_path,out_format):
+    out_file = str(tmp_path / f"cohort.pear_corr.{out_format}")
+
+    write_results(out_file,RECORDS,out_format=out_format)
+    write_results(out_file,APPEND_RECORDS,out_format=out_format,append=True)
+
+    results = read_results(out_file,out_format)
+    assert list(results["cii"]) == [r[0] for r in RECORDS + APPEND_RECORDS]
+    assert list(results["seed_mask"]) == [r[1] for r in RECORDS + APPEND_RECORDS]
+    assert list(results["stat_mask"]) == [r[2] for r in RECORDS + APPEND_RECORDS]
+    assert results["pear_corr"].dtype == np.float64
+    assert list(results["pear_corr"]) == [r[3] for r in RECORDS + APPEND_RECORDS]
+    assert glob.glob(str(tmp_path / "*.tmp")) == []
+
+def test_write_results_overwrite(tmp_path,out_format):
+    out_file = str(tmp_path / f"cohort.pear_corr.{out_format}")
+
+    write_results(out_file,RECORDS,out_format=out_format)
+    write_results(out_file,APPEND_RECORDS,out_format=out_format)
+
+    results = read_results(out_file,out_format)
+    assert list(results["pear_corr"]) == [r[3] for r in APPEND_RECORDS]
+
+def test_write_results_concurrent_append(tmp_path,out_format):
+    out_file = str(tmp_path / f"cohort.pear_corr.{out_format}")
+    n = 32
+
+    with multiprocessing.get_context("fork").Pool(8) as pool:
+        pool.map(append_worker,[(out_file,out_format,i) for i in range(n)])
+
+    results = read_results(out_file,out_format)
+    assert sorted(results["pear_corr"]) == [float(i) for i in range(n)]
+    assert len(results["cii"]) == n
+
+def test_write_results_empty(tmp_path,out_format):
+    out_file = str(tmp_path / f"cohort.pear_corr.{out_format}")
+
+    with pytest.raises(ValueError):
+        write_results(out_file,[],out_format=out_format)
+    assert not os.path.exists(out_file)
+
+def test_write_results_missing_column(tmp_path,out_format):
+    out_file = str(tmp_path / f"cohort.pear_corr.{out_format}")
+    write_results(out_file,RECORDS,out_format=out_format)
+
+    # Remove a column from the existing file
+    if out_format == "npz":
+        results = read_results(out_file,out_format)
+        del results["stat_mask"]
+        np.savez(out_file,**results)
+    else:
+        import h5py
+        with h5py.File(out_file,"a") as f:
+            del f["stat_mask"]
+
+    with pytest.raises(ValueError):
+        write_results(out_file,APPEND_RECORDS,out_format=out_format,append=True)
+
+    # Existing file is left untouched
+    results = read_results(out_file,out_format)
+    assert "stat_mask" not in results
+    assert [len(val) for val in results.values()] == [len(RECORDS)] * 3
+    assert glob.glob(str(tmp_path / "*.tmp")) == []
+
+def test_write_results_hdf5_append_in_place(tmp_path):
+    pytest.importorskip("h5py")
+    out_file = str(tmp_path / "cohort.pear_corr.h5")
+    path = "/data/cohort/derivatives/sub-%05d/func/sub-%05d_task-rest_space-fsLR_den-91k_bold.dtseries.nii"
+    n = 200
+
+    write_results(out_file,RECORDS,out_format="hdf5")
+    inode = os.stat(out_file).st_ino
+    size = os.path.getsize(out_file)
+
+    for i in range(n):
+        write_results(out_file,[(path % (i,i),"/data/masks/seed.dscalar.nii","/data/masks/stat.dscalar.nii",float(i))],
+                      out_format="hdf5",
+                      append=True)
+
+    # The file is appended to in place (not re-written) and grows by a small amount per row
+    assert os.stat(out_file).st_ino == inode
+    assert (os.path.getsize(out_file) - size) / n < 1024
+    assert len(read_results(out_file,"hdf5")["pear_corr"]) == len(RECORDS) + n
+
+def test_write_results_hdf5_interrupted_append(tmp_path):
+    h5py = pytest.importorskip("h5py")
+    out_file = str(tmp_path / "cohort.pear_corr.h5")
+    write_results(out_file,RECORDS,out_format="hdf5")
+
+    # Simulate an interrupted append (the 'pear_corr' column is written last)
+    with h5py.File(out_file,"a") as f:
+        f["cii"].resize((len(RECORDS) + 1,))
+        f["cii"][-1] = b"partial"
+
+    write_results(out_file,APPEND_RECORDS,out_format="hdf5",append=True)
+
+    results = read_results(out_file,"hdf5")
+    assert list(results["cii"]) == [r[0] for r in RECORDS + APPEND_RECORDS]
+    assert list(results["pear_corr"]) == [r[3] for r in RECORDS + APPEND_RECORDS]
+
+def test_write_results_hdf5_path_too_long(tmp_path):
+    pytest.importorskip("h5py")
+    out_file = str(tmp_path / "cohort.pear_corr.h5")
+
+    with pytest.raises(ValueError):
+        write_results(out_file,[("a" * (HDF5_STR_LEN + 1),"seed.dscalar.nii","stat.dscalar.nii",0.5)],out_format="hdf5")
+    assert not os.path.exists(out_file)
+
+def test_lock_file_unsupported(tmp_path,monkeypatch):
+    def flock(fd,operation):
+        raise OSError(errno.ENOSYS,"Function not implemented")
+    monkeypatch.setattr(corr_comp.fcntl,"flock",flock)
+
+    with pytest.raises(OSError,match="may not support file locking"):
+        write_results(str(tmp_path / "cohort.pear_corr.npz"),RECORDS,out_format="npz")
+
+def test_write_results_invalid_format(tmp_path):
+    with pytest.raises(ValueError):
+        write_results(str(tmp_path / "cohort.pear_corr.csv"),RECORDS,out_format="csv")
+
+def test_write_to_file_float_round_trip(tmp_path):
+    out_file = str(tmp_path / "test.pear_corr.txt")
+
+    for value in (0.1 + 0.2, np.float64(-0.4747918532163404), 1/3):
+        write_to_file(out_file,value)
+        assert float(np.loadtxt(out_file)) == value
+
+def test_atomic_write_permissions(tmp_path):
+    out_file = str(tmp_path / "test.txt")
+
+    write_to_file(out_file,"new")
+    assert stat.S_IMODE(os.stat(out_file).st_mode) == DEFAULT_FILE_MODE
+
+    os.chmod(out_file,0o640)
+    write_to_file(out_file,"replaced")
+    assert stat.S_IMODE(os.stat(out_file).st_mode) == 0o640
+
+def test_atomic_write_failure(tmp_path):
+    out_file = str(tmp_path / "test.txt")
+    write_to_file(out_file,"original")
+
+    def write_func(file):
+        file.write(b"partial")
+        raise RuntimeError("write failed")
+
+    with pytest.raises(RuntimeError):
+        atomic_write(out_file,write_func)
+
+    with open(out_file) as f:
+        assert f.read() == "original\n"
+    assert glob.glob(str(tmp_path / "*.tmp")) == []